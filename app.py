@@ -1,3 +1,4 @@
+import io
 import streamlit as st
 import pandas as pd
 import altair as alt
@@ -6,10 +7,11 @@ from datetime import datetime, timedelta
 from config import PAGE_TITLE, PAGE_ICON, THEME_COLOR, LANG_OPTIONS
 from db import init_db
 import auth
-import customers
 import logs
 import translate
 import backup
+import db_ops
+import maintenance
 
 
 # ---------------------------------------------------------
@@ -95,7 +97,8 @@ def top_nav():
 def page_customers():
     st.title("📋 客户管理")
 
-    df = customers.list_customers_df()
+    user, role = st.session_state["username"], st.session_state["role"]
+    df = db_ops.list_customers_df(user, role)
 
     with st.expander("➕ 添加客户"):
         rec = {}
@@ -108,17 +111,16 @@ def page_customers():
         rec["age"] = st.number_input("年龄", 0, 120)
         rec["job"] = st.text_input("工作")
         rec["income"] = st.text_input("薪资水平")
-        rec["marital_status"] = st.selectbox("感情状态", ["单身", "已婚", "离异", "丧偶"])
+        rec["relation"] = st.selectbox("感情状态", ["单身", "已婚", "离异", "丧偶"])
         rec["deal_amount"] = st.number_input("成交金额", 0.0)
         rec["level"] = st.selectbox("客户等级", ["普通", "重要", "VIP"])
         rec["progress"] = st.selectbox("跟进状态", ["待联系", "洽谈中", "已成交", "流失"])
-        rec["main_owner"] = st.text_input("主要负责人")
+        rec["main_person"] = st.text_input("主要负责人", value=user)
         rec["assistant"] = st.text_input("辅助人员")
-        rec["notes"] = st.text_area("备注")
-        rec["operator"] = st.session_state.get("username")
+        rec["remark"] = st.text_area("备注")
 
         if st.button("提交保存"):
-            cid = customers.insert_customer(rec)
+            cid = db_ops.add_customer_record(rec)
             st.success(f"客户已添加：{cid}")
             st.experimental_rerun()
 
@@ -133,17 +135,22 @@ def page_customers():
 
     st.dataframe(df)
 
+    if st.button("导出 Excel"):
+        buf = io.BytesIO()
+        db_ops.export_customers_xlsx(buf, user, role)
+        st.download_button("下载客户表", buf.getvalue(), file_name="customers.xlsx")
+
     # 搜索 / 筛选
     st.subheader("筛选")
     owner = st.text_input("按主要负责人搜索")
     if owner:
-        df = df[df["main_owner"] == owner]
+        df = df[df["main_person"] == owner]
 
     # 编辑 / 删除
     st.subheader("编辑 / 删除客户")
     cid = st.text_input("输入客户 ID")
     if cid:
-        cust = customers.get_customer(cid)
+        cust = db_ops.get_customer_by_id(cid, user, role)
         if not cust:
             st.error("未找到客户")
         else:
@@ -152,20 +159,28 @@ def page_customers():
             with st.form(f"edit_{cid}"):
                 updates = {}
                 for field in ["name", "whatsapp", "line", "telegram", "country", "city",
-                              "age", "job", "income", "marital_status", "deal_amount",
-                              "level", "progress", "main_owner", "assistant", "notes"]:
+                              "age", "job", "income", "relation", "deal_amount",
+                              "level", "progress", "main_person", "assistant", "remark"]:
                     updates[field] = st.text_input(field, value=str(cust.get(field)))
 
                 if st.form_submit_button("提交更新"):
-                    customers.update_customer(cid, updates, operator=st.session_state["username"])
-                    st.success("已更新")
-                    st.experimental_rerun()
+                    try:
+                        db_ops.update_customer(cid, updates, actor=user, role=role)
+                    except PermissionError:
+                        st.error("无权修改该客户")
+                    else:
+                        st.success("已更新")
+                        st.experimental_rerun()
 
             if st.checkbox("确认删除该客户"):
                 if st.button("删除客户"):
-                    customers.delete_customer(cid, operator=st.session_state["username"])
-                    st.success("客户已删除")
-                    st.experimental_rerun()
+                    try:
+                        db_ops.delete_customer(cid, actor=user, role=role)
+                    except PermissionError:
+                        st.error("无权删除该客户")
+                    else:
+                        st.success("客户已删除")
+                        st.experimental_rerun()
 
 
 # ---------------------------------------------------------
@@ -178,7 +193,8 @@ def page_followups():
     if not cid:
         return
 
-    cust = customers.get_customer(cid)
+    user, role = st.session_state["username"], st.session_state["role"]
+    cust = db_ops.get_customer_by_id(cid, user, role)
     if not cust:
         st.error("此客户不存在")
         return
@@ -190,12 +206,16 @@ def page_followups():
         note = st.text_area("跟进内容")
         next_action = st.text_input("下一步动作")
         if st.form_submit_button("提交"):
-            customers.add_followup(cid, st.session_state["username"], note, next_action)
-            st.success("跟进记录已创建")
-            st.experimental_rerun()
+            try:
+                db_ops.add_followup(cid, user, note, next_action, role=role)
+            except PermissionError:
+                st.error("无权跟进该客户")
+            else:
+                st.success("跟进记录已创建")
+                st.experimental_rerun()
 
     # 显示记录
-    df = customers.list_followups_df(cid)
+    df = db_ops.list_followups(cid, user, role)
     st.dataframe(df)
 
 
@@ -205,18 +225,20 @@ def page_followups():
 def page_charts():
     st.title("📊 负责人数据报表")
 
-    df = customers.list_customers_df()
+    user, role = st.session_state["username"], st.session_state["role"]
+    df = db_ops.list_customers_df(user, role)
     if df.empty:
         st.info("暂无客户数据")
         return
 
     # 负责人筛选
-    owner = st.selectbox("选择负责人", ["全部"] + sorted(df["main_owner"].unique().tolist()))
+    owner = st.selectbox("选择负责人", ["全部"] + sorted(df["main_person"].fillna("").unique().tolist()))
     if owner != "全部":
-        df = df[df["main_owner"] == owner]
+        df = df[df["main_person"].fillna("") == owner]
 
     # 时间筛选
     t = st.selectbox("时间区间", ["全部", "最近 7 天", "最近 30 天", "最近 90 天"])
+    days = None
     if t != "全部":
         days = {"最近 7 天": 7, "最近 30 天": 30, "最近 90 天": 90}[t]
         df = df[df["created_at"] >= (datetime.utcnow() - timedelta(days=days)).isoformat()]
@@ -244,6 +266,23 @@ def page_charts():
         )
         st.altair_chart(line, use_container_width=True)
 
+    # 负责人 KPI
+    st.subheader("负责人 KPI")
+    kpis = db_ops.owner_kpis_df(days, user, role)
+    funnel = db_ops.pipeline_funnel_df(days, user, role)
+    if owner != "全部":
+        kpis = kpis[kpis["main_person"] == owner]
+        funnel = funnel[funnel["main_person"] == owner]
+    st.dataframe(kpis)
+
+    st.subheader("跟进阶段漏斗")
+    bar = alt.Chart(funnel).mark_bar().encode(
+        x=alt.X("stage:N", sort=list(db_ops.PIPELINE_STAGES.values())),
+        y="sum(count):Q",
+        color="main_person:N"
+    )
+    st.altair_chart(bar, use_container_width=True)
+
 
 # ---------------------------------------------------------
 # 页面：操作日志
@@ -327,6 +366,25 @@ def page_backup():
         else:
             st.error(f"备份失败：{msg}")
 
+    st.subheader("数据库维护")
+    st.caption("合并重复客户（按 Whatsapp / Line / Telegram）、清理过期日志并压缩数据库")
+    if st.button("预览重复客户"):
+        st.session_state["maint_preview"] = maintenance.preview_duplicates()
+
+    preview = st.session_state.get("maint_preview")
+    if preview is not None:
+        groups, rows = preview
+        if rows:
+            st.write(f"发现 {len(groups)} 组重复客户（keep=True 为保留记录）：")
+            st.dataframe(pd.DataFrame(rows))
+        else:
+            st.info("未发现重复客户")
+        if st.button("确认合并并运行维护"):
+            report = maintenance.run_maintenance(actor=st.session_state["username"], groups=groups)
+            del st.session_state["maint_preview"]
+            st.success("维护完成")
+            st.json(report)
+
 
 # ---------------------------------------------------------
 # 主程序入口
@@ -0,0 +1,48 @@
+# bench_kpis.py
+# Usage: python bench_kpis.py [n_customers] [n_followups]
+# Builds a throwaway database and times owner_kpis_df() cold and cached.
+import sys
+import time
+import random
+import pathlib
+import tempfile
+from datetime import datetime, timedelta
+import db_ops
+
+def populate(n_customers, n_followups, n_owners=50):
+    owners = [f"user{i}" for i in range(n_owners)]
+    stages = list(db_ops.PIPELINE_STAGES.values())
+    now = datetime.utcnow()
+    conn = db_ops.get_conn()
+    conn.executemany(
+        "INSERT INTO customers(id,main_person,progress,deal_amount,created_at) VALUES (?,?,?,?,?)",
+        ((str(i), random.choice(owners), random.choice(stages), random.random() * 10000,
+          (now - timedelta(days=random.randint(0, 365))).isoformat()) for i in range(n_customers)))
+    conn.executemany(
+        "INSERT INTO followups(id,customer_id,author,created_at) VALUES (?,?,?,?)",
+        ((str(i), str(random.randrange(n_customers)), random.choice(owners),
+          (now - timedelta(days=random.randint(0, 365))).isoformat()) for i in range(n_followups)))
+    conn.commit()
+    conn.close()
+
+def main():
+    n_customers = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_followups = int(sys.argv[2]) if len(sys.argv) > 2 else n_customers
+    with tempfile.TemporaryDirectory() as tmp:
+        db_ops.DB_FILE = pathlib.Path(tmp) / "bench.sqlite"
+        db_ops.init_db()
+        t = time.perf_counter()
+        populate(n_customers, n_followups)
+        print(f"populated {n_customers} customers / {n_followups} followups in {time.perf_counter() - t:.1f}s")
+        for days in (7, 30, 90, None):
+            db_ops.clear_kpi_cache()
+            t = time.perf_counter()
+            df = db_ops.owner_kpis_df(days)
+            cold = time.perf_counter() - t
+            t = time.perf_counter()
+            db_ops.owner_kpis_df(days)
+            cached = time.perf_counter() - t
+            print(f"window={days}: {len(df)} owners, cold {cold:.3f}s, cached {cached * 1000:.2f}ms")
+
+if __name__ == "__main__":
+    main()
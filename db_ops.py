@@ -3,8 +3,9 @@ import sqlite3
 import pathlib
 import uuid
 import hashlib
+import time
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 
 DB_FILE = pathlib.Path("crm_data.sqlite")
 
@@ -65,6 +66,15 @@ def init_db():
         created_at TEXT
     )""")
 
+    # indexes for windowed reporting
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_created_at ON customers(created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_followups_customer_id ON followups(customer_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_followups_created_at ON followups(created_at)")
+
+    # indexes for per-user row scoping
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_main_person ON customers(main_person)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_customers_assistant ON customers(assistant)")
+
     # translations
     cur.execute("""
     CREATE TABLE IF NOT EXISTS translations (
@@ -141,6 +151,53 @@ def delete_user(username):
     log_action(username, "delete_user", "users", username, "")
     conn.close()
 
+# Row scoping
+# Normal users only see customers where they are main_person or assistant.
+# username=None (system context) or role="admin" means unscoped; when role is
+# not given it is looked up from users (unknown users are scoped).
+VISIBLE_IDS_TTL = 60  # seconds
+_visible_ids_cache = {}
+
+def get_user_role(username):
+    conn = get_conn()
+    row = conn.execute("SELECT role FROM users WHERE username=?", (username,)).fetchone()
+    conn.close()
+    return row["role"] if row else None
+
+def _is_scoped(username, role):
+    if username is None:
+        return False
+    if role is None:
+        role = get_user_role(username)
+    return role != "admin"
+
+def _scope_sql(username, role, alias=""):
+    if not _is_scoped(username, role):
+        return "1=1", ()
+    p = f"{alias}." if alias else ""
+    return f"({p}main_person=? OR {p}assistant=?)", (username, username)
+
+def clear_visible_ids_cache():
+    _visible_ids_cache.clear()
+
+def visible_customer_ids(username=None, role=None):
+    """Set of customer ids the user may see, or None when unscoped."""
+    if not _is_scoped(username, role):
+        return None
+    hit = _visible_ids_cache.get(username)
+    if hit and time.time() - hit[0] < VISIBLE_IDS_TTL:
+        return hit[1]
+    where, params = _scope_sql(username, role)
+    conn = get_conn()
+    ids = frozenset(r[0] for r in conn.execute(f"SELECT id FROM customers WHERE {where}", params))
+    conn.close()
+    _visible_ids_cache[username] = (time.time(), ids)
+    return ids
+
+def can_access_customer(cid, username=None, role=None):
+    ids = visible_customer_ids(username, role)
+    return ids is None or cid in ids
+
 # Customer ops
 def add_customer_record(rec: dict):
     conn = get_conn()
@@ -171,16 +228,21 @@ def add_customer_record(rec: dict):
     cur.execute(f"INSERT INTO customers({keys}) VALUES ({vals})", tuple(rec_db.values()))
     conn.commit()
     conn.close()
+    clear_kpi_cache()
+    clear_visible_ids_cache()
     log_action(rec_db["main_person"] or "system", "add_customer", "customers", cid, str(rec_db))
     return cid
 
-def list_customers_df():
+def list_customers_df(username=None, role=None):
+    where, params = _scope_sql(username, role)
     conn = get_conn()
-    df = pd.read_sql_query("SELECT * FROM customers", conn)
+    df = pd.read_sql_query(f"SELECT * FROM customers WHERE {where}", conn, params=params)
     conn.close()
     return df
 
-def get_customer_by_id(cid):
+def get_customer_by_id(cid, username=None, role=None):
+    if not can_access_customer(cid, username, role):
+        return None
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT * FROM customers WHERE id=?", (cid,))
@@ -188,39 +250,153 @@ def get_customer_by_id(cid):
     conn.close()
     return dict(row) if row else None
 
-def update_customer(cid, updates: dict, actor="system"):
+# Writes: actor=None is a system caller (unscoped). Otherwise the scope
+# predicate is part of the write statement itself; a missing customer returns
+# False, an existing one outside the actor's scope raises PermissionError.
+def _customer_exists(conn, cid):
+    return conn.execute("SELECT 1 FROM customers WHERE id=?", (cid,)).fetchone() is not None
+
+def update_customer(cid, updates: dict, actor=None, role=None):
+    where, params = _scope_sql(actor, role)
     conn = get_conn()
     cur = conn.cursor()
     set_sql = ",".join([f"{k}=?" for k in updates.keys()])
-    cur.execute(f"UPDATE customers SET {set_sql} WHERE id=?", tuple(list(updates.values()) + [cid]))
+    cur.execute(f"UPDATE customers SET {set_sql} WHERE id=? AND {where}",
+                tuple(list(updates.values()) + [cid]) + params)
+    changed = cur.rowcount
     conn.commit()
+    exists = changed or _customer_exists(conn, cid)
     conn.close()
-    log_action(actor, "update_customer", "customers", cid, str(updates))
+    if not changed:
+        if exists:
+            raise PermissionError(f"{actor} has no access to customer {cid}")
+        return False
+    clear_kpi_cache()
+    clear_visible_ids_cache()
+    log_action(actor or "system", "update_customer", "customers", cid, str(updates))
+    return True
 
-def delete_customer(cid, actor="system"):
+def delete_customer(cid, actor=None, role=None):
+    where, params = _scope_sql(actor, role)
     conn = get_conn()
-    conn.execute("DELETE FROM customers WHERE id=?", (cid,))
+    cur = conn.execute(f"DELETE FROM customers WHERE id=? AND {where}", (cid,) + params)
+    changed = cur.rowcount
     conn.commit()
+    exists = not changed and _customer_exists(conn, cid)
     conn.close()
-    log_action(actor, "delete_customer", "customers", cid, "")
+    if not changed:
+        if exists:
+            raise PermissionError(f"{actor} has no access to customer {cid}")
+        return False
+    clear_kpi_cache()
+    clear_visible_ids_cache()
+    log_action(actor or "system", "delete_customer", "customers", cid, "")
+    return True
+
+def export_customers_xlsx(path_or_buffer, username=None, role=None):
+    df = list_customers_df(username, role)
+    df.to_excel(path_or_buffer, index=False)
+    log_action(username or "system", "export_customers", "customers", "", f"rows={len(df)}")
+    return len(df)
 
 # Followups
-def add_followup(cid, author, note, next_action=""):
+def add_followup(cid, author, note, next_action="", role=None):
+    """author=None records a system followup (unscoped)."""
+    where, params = _scope_sql(author, role)
     conn = get_conn()
     cur = conn.cursor()
     fid = str(uuid.uuid4())
-    cur.execute("INSERT INTO followups(id,customer_id,author,note,next_action,created_at) VALUES (?,?,?,?,?,?)",
-                (fid, cid, author, note, next_action, datetime.utcnow().isoformat()))
+    cur.execute(f"INSERT INTO followups(id,customer_id,author,note,next_action,created_at) "
+                f"SELECT ?,?,?,?,?,? WHERE ? IS NULL OR EXISTS (SELECT 1 FROM customers WHERE id=? AND {where})",
+                (fid, cid, author or "system", note, next_action, datetime.utcnow().isoformat(),
+                 None if where == "1=1" else 1, cid) + params)
+    changed = cur.rowcount
     conn.commit()
     conn.close()
-    log_action(author, "add_followup", "followups", fid, f"customer_id={cid}")
+    if not changed:
+        raise PermissionError(f"{author} has no access to customer {cid}")
+    clear_kpi_cache()
+    log_action(author or "system", "add_followup", "followups", fid, f"customer_id={cid}")
+    return fid
 
-def list_followups(cid):
+def list_followups(cid, username=None, role=None):
+    if not can_access_customer(cid, username, role):
+        return pd.DataFrame(columns=["id", "customer_id", "author", "note", "next_action", "created_at"])
     conn = get_conn()
     df = pd.read_sql_query("SELECT * FROM followups WHERE customer_id=? ORDER BY created_at DESC", conn, params=(cid,))
     conn.close()
     return df
 
+# KPIs
+PIPELINE_STAGES = {"pending": "待联系", "negotiating": "洽谈中", "won": "已成交", "lost": "流失"}
+KPI_CACHE_TTL = 60  # seconds
+_kpi_cache = {}
+
+def clear_kpi_cache():
+    _kpi_cache.clear()
+
+def owner_kpis_df(days=None, username=None, role=None):
+    """Per-owner KPIs for customers created in the last `days` days (None = all time).
+
+    One SQL aggregation pass: stage funnel counts, conversion rate, average and
+    total deal amount of won customers, and followup frequency. Followups are
+    counted only for that same cohort of customers (and only those logged in the
+    window), so followups_per_customer = followups / customers. Results are
+    cached per window (and per user when scoped) for KPI_CACHE_TTL seconds and
+    cleared on writes.
+    """
+    key = (days, username if _is_scoped(username, role) else None)
+    hit = _kpi_cache.get(key)
+    if hit and time.time() - hit[0] < KPI_CACHE_TTL:
+        return hit[1].copy()
+
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat() if days is not None else ""
+    where, scope = _scope_sql(username, role)
+    c_where, _ = _scope_sql(username, role, alias="c")
+    stage_cols = ",\n".join(f"SUM(progress = '{v}') AS {k}" for k, v in PIPELINE_STAGES.items())
+    sql = f"""
+    WITH cw AS (
+        SELECT COALESCE(main_person, '') AS main_person,
+               COUNT(1) AS customers,
+               {stage_cols},
+               AVG(CASE WHEN progress = '已成交' THEN deal_amount END) AS avg_deal_amount,
+               SUM(CASE WHEN progress = '已成交' THEN deal_amount ELSE 0 END) AS total_deal_amount
+        FROM customers WHERE created_at >= ? AND {where} GROUP BY 1
+    ), fw AS (
+        SELECT COALESCE(c.main_person, '') AS main_person, COUNT(1) AS followups
+        FROM followups f JOIN customers c ON c.id = f.customer_id
+        WHERE c.created_at >= ? AND f.created_at >= ? AND {c_where} GROUP BY 1
+    )
+    SELECT cw.main_person, cw.customers, {", ".join(f"cw.{k}" for k in PIPELINE_STAGES)},
+           cw.avg_deal_amount, cw.total_deal_amount, COALESCE(fw.followups, 0) AS followups
+    FROM cw
+    LEFT JOIN fw ON fw.main_person = cw.main_person
+    ORDER BY cw.main_person
+    """
+    conn = get_conn()
+    df = pd.read_sql_query(sql, conn, params=(since, *scope, since, since, *scope))
+    conn.close()
+
+    count_cols = ["customers", *PIPELINE_STAGES, "followups"]
+    df[count_cols] = df[count_cols].fillna(0).astype(int)
+    df[["avg_deal_amount", "total_deal_amount"]] = df[["avg_deal_amount", "total_deal_amount"]].astype(float)
+    df["total_deal_amount"] = df["total_deal_amount"].fillna(0.0)
+    n = df["customers"].where(df["customers"] > 0)
+    df["conversion_rate"] = (df["won"] / n).fillna(0.0)
+    df["followups_per_customer"] = (df["followups"] / n).fillna(0.0)
+    df["window_days"] = days
+
+    _kpi_cache[key] = (time.time(), df)
+    return df.copy()
+
+def pipeline_funnel_df(days=None, username=None, role=None):
+    """Long-form stage counts per owner (main_person, stage, count) for charting."""
+    df = owner_kpis_df(days, username, role)
+    funnel = df.melt(id_vars="main_person", value_vars=list(PIPELINE_STAGES),
+                     var_name="stage", value_name="count")
+    funnel["stage"] = funnel["stage"].map(PIPELINE_STAGES)
+    return funnel
+
 # Translations storage (optional)
 def upsert_translation_row(key, zh, en, idn, km, vn):
     conn = get_conn()
@@ -0,0 +1,270 @@
+# maintenance.py
+import re
+import time
+from datetime import datetime, timedelta
+from db_ops import get_conn, log_action, clear_kpi_cache, clear_visible_ids_cache, DB_FILE
+
+HANDLE_FIELDS = ("whatsapp", "line", "telegram")
+MERGE_FIELDS = ("name", "whatsapp", "line", "telegram", "country", "city", "age", "job", "income",
+                "relation", "remark")
+# taken together from the row with the most advanced stage, so a won deal keeps its amount and owner
+DEAL_FIELDS = ("progress", "deal_amount", "level", "main_person", "assistant")
+# 流失 ranks below every open stage: it only wins when no row is further along
+STAGE_RANK = {"已成交": 3, "洽谈中": 2, "待联系": 1, "流失": 0}
+LOG_RETENTION_DAYS = 365
+MIN_HANDLE_LEN = 4
+# values staff type when a customer has no such account
+PLACEHOLDER_HANDLES = {"无", "没有", "暂无", "未知", "空", "none", "null", "nil", "na", "n/a",
+                       "no", "nope", "unknown", "empty", "test", "xxx", "xxxx", "-", "--", "---"}
+
+# queries timed before/after compaction; params filled by _bench_params()
+BENCH_QUERIES = [
+    ("SELECT * FROM customers WHERE main_person=?", ("owner",)),
+    ("SELECT main_person, COUNT(1) FROM customers GROUP BY main_person", ()),
+    ("SELECT * FROM followups WHERE customer_id=? ORDER BY created_at DESC", ("customer_id",)),
+    ("SELECT * FROM action_logs ORDER BY created_at DESC LIMIT 200", ()),
+]
+
+def normalize_handle(field, value):
+    """Normalised handle, or "" when the value is empty or a placeholder."""
+    if value is None:
+        return ""
+    v = str(value).strip().lower()
+    if v in PLACEHOLDER_HANDLES:
+        return ""
+    if field == "whatsapp":
+        # phone number: digits only, drop leading 00 international prefix
+        v = re.sub(r"\D", "", v)
+        if v.startswith("00"):
+            v = v[2:]
+        # reject short or repeated-digit fillers like 000000
+        return v if len(v) >= 6 and len(set(v)) > 1 else ""
+    v = re.sub(r"\s+", "", v).lstrip("@")
+    if v in PLACEHOLDER_HANDLES or len(v) < MIN_HANDLE_LEN or not any(ch.isalnum() for ch in v):
+        return ""
+    return v
+
+def find_duplicate_groups(conn):
+    """Group customers sharing any normalised contact handle.
+
+    Builds a (field, handle) -> ids blocking index in one scan and joins
+    overlapping blocks with union-find, so no pairwise comparison is needed.
+    Returns lists of ids, oldest first.
+    """
+    rows = conn.execute("SELECT id, whatsapp, line, telegram, created_at FROM customers").fetchall()
+    parent = {}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    blocks = {}
+    created = {}
+    for r in rows:
+        cid = r["id"]
+        parent[cid] = cid
+        created[cid] = r["created_at"] or ""
+        for f in HANDLE_FIELDS:
+            h = normalize_handle(f, r[f])
+            if not h:
+                continue
+            first = blocks.setdefault((f, h), cid)
+            if first != cid:
+                a, b = find(first), find(cid)
+                if a != b:
+                    parent[b] = a
+
+    groups = {}
+    for cid in parent:
+        groups.setdefault(find(cid), []).append(cid)
+    return [sorted(g, key=lambda c: (created[c], c)) for g in groups.values() if len(g) > 1]
+
+def describe_groups(conn, groups):
+    """Rows of each group (group number, id, name, handles, owner) for previewing a merge."""
+    out = []
+    for n, ids in enumerate(groups, 1):
+        rows = {r["id"]: dict(r) for r in conn.execute(
+            f"SELECT id,name,whatsapp,line,telegram,main_person,created_at FROM customers "
+            f"WHERE id IN ({','.join('?' for _ in ids)})", ids)}
+        for i, cid in enumerate(ids):
+            if cid in rows:
+                out.append({"group": n, "keep": i == 0, **rows[cid]})
+    return out
+
+def _deal_source(rows, ids):
+    """Row with the most advanced stage; ties go to the larger deal amount, then the older row."""
+    def rank(i):
+        r = rows[ids[i]]
+        return (STAGE_RANK.get(r["progress"], -1), r["deal_amount"] or 0.0, -i)
+    return ids[max(range(len(ids)), key=rank)]
+
+def merge_customers(conn, ids):
+    """Merge ids into ids[0], the oldest row.
+
+    Stage, deal amount, level and owners come together from the most advanced row
+    (see _deal_source); other empty fields on the kept row are filled from the rest.
+    Followups move to the kept row and the others are deleted. Returns an audit
+    record with previous owners, deleted rows and moved followup ids so the merge
+    can be reversed.
+    """
+    rows = {r["id"]: dict(r) for r in conn.execute(
+        f"SELECT * FROM customers WHERE id IN ({','.join('?' for _ in ids)})", ids)}
+    ids = [c for c in ids if c in rows]
+    if len(ids) < 2:
+        return None
+    keep, dupes = ids[0], ids[1:]
+    original = dict(rows[keep])
+    base = rows[keep]
+    updates = {}
+    source = rows[_deal_source(rows, ids)]
+    for f in DEAL_FIELDS:
+        if source[f] not in (None, "") and source[f] != base[f]:
+            base[f] = updates[f] = source[f]
+    for cid in dupes:
+        for f in MERGE_FIELDS:
+            if base.get(f) in (None, "") and rows[cid].get(f) not in (None, ""):
+                base[f] = updates[f] = rows[cid][f]
+    if updates:
+        set_sql = ",".join(f"{k}=?" for k in updates)
+        conn.execute(f"UPDATE customers SET {set_sql} WHERE id=?", tuple(updates.values()) + (keep,))
+    marks = ",".join("?" for _ in dupes)
+    moved = {}
+    for r in conn.execute(f"SELECT id, customer_id FROM followups WHERE customer_id IN ({marks})", dupes):
+        moved.setdefault(r["customer_id"], []).append(r["id"])
+    conn.execute(f"UPDATE followups SET customer_id=? WHERE customer_id IN ({marks})", (keep, *dupes))
+    conn.execute(f"DELETE FROM customers WHERE id IN ({marks})", dupes)
+    return {
+        "kept": keep,
+        "merged": dupes,
+        "previous_owners": {c: (original if c == keep else rows[c])["main_person"] for c in ids},
+        "owner": base["main_person"],
+        "kept_before": original,
+        "deleted_rows": [rows[c] for c in dupes],
+        "moved_followups": moved,
+    }
+
+def apply_retention(conn, log_days=LOG_RETENTION_DAYS):
+    """Drop action logs older than log_days and followups whose customer no longer exists."""
+    cutoff = (datetime.utcnow() - timedelta(days=log_days)).isoformat()
+    logs = conn.execute("DELETE FROM action_logs WHERE created_at < ?", (cutoff,)).rowcount
+    orphans = conn.execute(
+        "DELETE FROM followups WHERE customer_id NOT IN (SELECT id FROM customers)").rowcount
+    return {"action_logs_deleted": logs, "orphan_followups_deleted": orphans}
+
+def _db_bytes(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_size * pages, page_size * free
+
+def _bench_params(conn, exclude=()):
+    """Busiest owner and busiest surviving customer, so timings hit real rows."""
+    row = conn.execute("SELECT main_person FROM customers WHERE main_person IS NOT NULL "
+                       "GROUP BY main_person ORDER BY COUNT(1) DESC LIMIT 1").fetchone()
+    owner = row[0] if row else ""
+    customer_id = ""
+    for r in conn.execute("SELECT f.customer_id FROM followups f JOIN customers c ON c.id = f.customer_id "
+                          "GROUP BY f.customer_id ORDER BY COUNT(1) DESC LIMIT 100"):
+        if r[0] not in exclude:
+            customer_id = r[0]
+            break
+    return {"owner": owner, "customer_id": customer_id}
+
+def _time_queries(conn, params, repeat=5):
+    queries = [(sql, tuple(params[k] for k in keys)) for sql, keys in BENCH_QUERIES]
+    # warm-up pass so before and after both run on a warm page cache
+    for sql, args in queries:
+        conn.execute(sql, args).fetchall()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        for sql, args in queries:
+            conn.execute(sql, args).fetchall()
+    return (time.perf_counter() - t) / repeat
+
+def compact(conn):
+    """Switch to incremental auto-vacuum (one full VACUUM the first time), then reclaim free pages and ANALYZE."""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        # the pragma frees one page per step; execute()/fetchall() stop after the first
+        # step, executescript() runs it to completion
+        conn.executescript("PRAGMA incremental_vacuum;")
+    conn.execute("ANALYZE")
+
+def preview_duplicates():
+    """Dry run: duplicate groups (oldest id first) and their rows, without changing anything."""
+    conn = get_conn()
+    groups = find_duplicate_groups(conn)
+    rows = describe_groups(conn, groups)
+    conn.close()
+    return groups, rows
+
+def run_maintenance(actor="system", log_days=LOG_RETENTION_DAYS, dedupe=True, groups=None):
+    """Deduplicate customers, apply retention rules and compact the database. Returns a report dict.
+
+    Pass the groups returned by preview_duplicates() to merge what was previewed; a
+    previewed group is skipped if its members no longer share a handle.
+    Each merge is logged to action_logs with the kept id, merged ids, previous
+    owners and deleted rows.
+    """
+    conn = get_conn()
+    stale_groups = 0
+    if not dedupe:
+        groups = []
+    else:
+        fresh = find_duplicate_groups(conn)
+        if groups is None:
+            groups = fresh
+        else:
+            fresh_of = {c: i for i, ids in enumerate(fresh) for c in ids}
+            checked = [ids for ids in groups
+                       if len({fresh_of.get(c) for c in ids}) == 1 and ids[0] in fresh_of]
+            stale_groups = len(groups) - len(checked)
+            groups = checked
+    params = _bench_params(conn, exclude={c for ids in groups for c in ids[1:]})
+    size_before, _ = _db_bytes(conn)
+    query_before = _time_queries(conn, params)
+
+    merged_groups = merged_rows = 0
+    owner_changes = []
+    for ids in groups:
+        audit = merge_customers(conn, ids)
+        if audit is None:
+            continue
+        conn.commit()
+        log_action(actor, "merge_customers", "customers", audit["kept"], str(audit))
+        if set(audit["previous_owners"].values()) != {audit["owner"]}:
+            owner_changes.append({"kept": audit["kept"], "previous_owners": audit["previous_owners"],
+                                  "owner": audit["owner"]})
+        merged_groups += 1
+        merged_rows += len(audit["merged"])
+    retention = apply_retention(conn, log_days)
+    conn.commit()
+
+    compact(conn)
+    size_after, free_after = _db_bytes(conn)
+    query_after = _time_queries(conn, params)
+    conn.close()
+
+    clear_kpi_cache()
+    clear_visible_ids_cache()
+    report = {
+        "db_file": str(DB_FILE),
+        "duplicate_groups_merged": merged_groups,
+        "duplicate_customers_removed": merged_rows,
+        "stale_groups_skipped": stale_groups,
+        "owner_changes": owner_changes,
+        **retention,
+        "bytes_before": size_before,
+        "bytes_after": size_after,
+        "bytes_reclaimed": size_before - size_after,
+        "free_bytes_remaining": free_after,
+        "query_seconds_before": round(query_before, 6),
+        "query_seconds_after": round(query_after, 6),
+        "query_speedup": round(query_before / query_after, 2) if query_after else None,
+    }
+    log_action(actor, "maintenance", "db", "", str(report))
+    return report